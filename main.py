@@ -1,96 +1,71 @@
-import json
+import asyncio
 import os
-from typing import Any, Dict, List, Optional
+import re
+from typing import Annotated, Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, Form, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.templating import Jinja2Templates
-from openai import OpenAI
+from openai import APIError, AsyncOpenAI, RateLimitError
 
-app = FastAPI()
-templates = Jinja2Templates(directory="templates")
-
-def clamp_text(s: str, max_chars: int) -> str:
-    s = s.strip()
-    return s[:max_chars] if len(s) > max_chars else s
-
-def empty_payload() -> Dict[str, Any]:
-    return {
-        "summary": {"breathing": [], "feeding": [], "growth": [], "events": []},
-        "questions": {"breathing": [], "feeding": [], "growth": [], "events": [], "discharge": []},
-    }
-
-def enforce_shape(obj: Any) -> Dict[str, Any]:
-    base = empty_payload()
-    if not isinstance(obj, dict):
-        return base
+API_KEY = os.getenv("OPENAI_API_KEY") or None
 
-    for sec in ["breathing", "feeding", "growth", "events"]:
-        arr = obj.get("summary", {}).get(sec)
-        if isinstance(arr, list):
-            base["summary"][sec] = [str(x) for x in arr if isinstance(x, str)]
+app = FastAPI(default_response_class=ORJSONResponse)
+templates = Jinja2Templates(directory="templates")
 
-    for sec in ["breathing", "feeding", "growth", "events", "discharge"]:
-        arr = obj.get("questions", {}).get(sec)
-        if isinstance(arr, list):
-            base["questions"][sec] = [str(x) for x in arr if isinstance(x, str)]
+# The index template has no per-request context, so render it once
+INDEX_HTML = templates.get_template("index.html").render().encode()
 
-    # Cap total questions at 12
-    total = 0
-    for sec in ["breathing", "feeding", "growth", "events", "discharge"]:
-        trimmed: List[str] = []
-        for q in base["questions"][sec]:
-            if total >= 12:
-                break
-            trimmed.append(q)
-            total += 1
-        base["questions"][sec] = trimmed
+@app.exception_handler(RequestValidationError)
+async def _validation_error(request: Request, exc: RequestValidationError):
+    # The page reads "error" from failed responses
+    return ORJSONResponse({"error": "Some fields are missing or too long. Please check the form."}, status_code=422)
 
-    return base
+@app.on_event("startup")
+async def _require_api_key():
+    if API_KEY is None:
+        raise RuntimeError("Missing OPENAI_API_KEY env var on server.")
 
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+# Upper bound on simultaneous OpenAI calls; also sizes the HTTP connection pool
+MAX_UPSTREAM_CONCURRENCY = 200
 
-@app.post("/api/generate", response_class=JSONResponse)
-async def generate(
-    dateISO: str = Form(...),
-    respSupport: str = Form(...),
-    feedingMethod: str = Form(...),
-    weightKg: Optional[str] = Form(None),
-    cgaWeeks: Optional[str] = Form(None),
-    cgaDays: Optional[str] = Form(None),
-    weightHistory: Optional[str] = Form(None),
-    notes: Optional[str] = Form(None),
-):
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return JSONResponse({"error": "Missing OPENAI_API_KEY env var on server."}, status_code=500)
+# HTTP/2 lets concurrent OpenAI calls multiplex over a few pooled connections
+_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=MAX_UPSTREAM_CONCURRENCY,
+        max_keepalive_connections=MAX_UPSTREAM_CONCURRENCY // 2,
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+_client: Optional[AsyncOpenAI] = None
+_upstream_slots = asyncio.Semaphore(MAX_UPSTREAM_CONCURRENCY)
 
-    dateISO = clamp_text(dateISO, 20)
-    respSupport = clamp_text(respSupport, 30)
-    feedingMethod = clamp_text(feedingMethod, 30)
-    weightKg = clamp_text(weightKg, 20) if weightKg else None
-    weightHistory = clamp_text(weightHistory, 300) if weightHistory else None
-    notes = clamp_text(notes, 1200) if notes else None
+def get_client() -> AsyncOpenAI:
+    # One shared client so connections to the OpenAI API are pooled across requests
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(api_key=API_KEY, http_client=_http)
+    return _client
 
-    cga: Optional[str] = None
-    if cgaWeeks:
-        try:
-            w = int(cgaWeeks)
-            d = int(cgaDays) if cgaDays else 0
-            if 22 <= w <= 44 and 0 <= d <= 6:
-                cga = f"{w}+{d}"
-        except ValueError:
-            pass
+@app.on_event("shutdown")
+async def _close_http():
+    await _http.aclose()
 
-    if not notes and not weightKg and respSupport == "Room air" and feedingMethod == "Combo":
-        return empty_payload()
+# Final payloads keyed on the normalized form inputs, so repeat submissions skip the LLM call
+_response_cache: TTLCache = TTLCache(maxsize=512, ttl=3600)
+# Upstream calls currently running, keyed like the cache; identical concurrent submissions
+# await the same task and share its result or error
+_inflight: Dict[tuple, "asyncio.Task[Dict[str, Any]]"] = {}
 
-    system = """
+SYSTEM_PROMPT = """
 You are a knowledgeable NICU family support assistant helping parents prepare for medical rounds.
 You do NOT provide medical advice, diagnoses, or treatment recommendations.
 
@@ -130,7 +105,7 @@ Generate 4–7 questions total. Fewer, sharper questions are better than many ge
 Only generate questions for categories where there is relevant data. Leave others empty.
 """.strip()
 
-    developer = """
+DEVELOPER_PROMPT = """
 Return JSON only. No markdown. No extra text.
 
 Structure:
@@ -151,35 +126,203 @@ Rules:
 - If a category has no relevant data, leave its list empty — do not guess or pad
 """.strip()
 
-    user = f"""
-Today's info:
-Date: {dateISO}
-Corrected gestational age: {cga + " weeks" if cga else "unknown"}
-Respiratory support: {respSupport}
-Feeding: {feedingMethod}
-Weight (kg): {weightKg or "unknown"}
-Weight history: {weightHistory or "none"}
-
-Parent notes:
-{notes or "none"}
-""".strip()
+_USER_TMPL = (
+    "Today's info:\n"
+    "Date: {dateISO}\n"
+    "Corrected gestational age: {cga}\n"
+    "Respiratory support: {respSupport}\n"
+    "Feeding: {feedingMethod}\n"
+    "Weight (kg): {weightKg}\n"
+    "Weight history: {weightHistory}\n"
+    "\n"
+    "Parent notes:\n"
+    "{notes}"
+)
 
-    client = OpenAI(api_key=api_key)
+# Short submissions go to the cheaper model; longer parent notes get the larger one
+SMALL_MODEL = "gpt-4.1-nano"
+DEFAULT_MODEL = "gpt-4.1-mini"
+LONG_NOTES_CHARS = 400
 
-    try:
-        resp = client.chat.completions.create(
-            model="gpt-4.1-mini",
+# Static prefix of every chat request, kept first and byte-identical for prompt caching;
+# only the user message varies
+_BASE_MESSAGES = (
+    {"role": "system", "content": SYSTEM_PROMPT},
+    {"role": "developer", "content": DEVELOPER_PROMPT},
+)
+
+_SUMMARY_SECS = ("breathing", "feeding", "growth", "events")
+_QUESTION_SECS = _SUMMARY_SECS + ("discharge",)
+_TOP_KEYS = ("summary", "questions")
+
+# Matches the textarea's maxlength; the Form cap allows for each line break arriving as CRLF
+NOTES_MAX_CHARS = 1200
+# Weight history is truncated to this many characters; the raw field gets a looser hard cap since the
+# page builds it from stored entries and can legitimately exceed it
+WEIGHT_HISTORY_MAX_CHARS = 300
+WEIGHT_HISTORY_FORM_CAP = 2000
+# Fits the zero-padded values number inputs can send, e.g. "030"
+CGA_FORM_CAP = 3
+
+# ASCII digits only; allows the leading zero number inputs send as typed (e.g. "05", "030")
+_CGA_NUM_RE = re.compile(r"[0-9]{1,3}")
+
+def clamp_text(s: str, max_chars: int) -> str:
+    return s.strip()[:max_chars]
+
+def empty_payload() -> Dict[str, Any]:
+    return {
+        "summary": {"breathing": [], "feeding": [], "growth": [], "events": []},
+        "questions": {"breathing": [], "feeding": [], "growth": [], "events": [], "discharge": []},
+    }
+
+# Serialized once for the early-return path, which never needs a mutable copy
+_EMPTY_PAYLOAD_BYTES = orjson.dumps(empty_payload())
+
+def _is_well_shaped(obj: Any) -> bool:
+    # True when obj already matches the payload schema exactly, keys in canonical order,
+    # with at most 12 questions
+    if not isinstance(obj, dict) or tuple(obj) != _TOP_KEYS:
+        return False
+    summary, questions = obj["summary"], obj["questions"]
+    if not isinstance(summary, dict) or tuple(summary) != _SUMMARY_SECS:
+        return False
+    if not isinstance(questions, dict) or tuple(questions) != _QUESTION_SECS:
+        return False
+    total = 0
+    for arr in questions.values():
+        if not isinstance(arr, list):
+            return False
+        total += len(arr)
+        if total > 12 or not all(isinstance(x, str) for x in arr):
+            return False
+    for arr in summary.values():
+        if not isinstance(arr, list) or not all(isinstance(x, str) for x in arr):
+            return False
+    return True
+
+def enforce_shape(obj: Any) -> Dict[str, Any]:
+    if _is_well_shaped(obj):
+        return obj
+    if not isinstance(obj, dict):
+        return empty_payload()
+
+    summary_in = obj.get("summary")
+    if not isinstance(summary_in, dict):
+        summary_in = {}
+    questions_in = obj.get("questions")
+    if not isinstance(questions_in, dict):
+        questions_in = {}
+
+    summary: Dict[str, List[str]] = {}
+    for sec in _SUMMARY_SECS:
+        arr = summary_in.get(sec)
+        summary[sec] = [x for x in arr if isinstance(x, str)] if isinstance(arr, list) else []
+
+    # Cap total questions at 12
+    questions: Dict[str, List[str]] = {}
+    total = 0
+    for sec in _QUESTION_SECS:
+        out: List[str] = []
+        arr = questions_in.get(sec)
+        if isinstance(arr, list) and total < 12:
+            for x in arr:
+                if not isinstance(x, str):
+                    continue
+                out.append(x)
+                total += 1
+                if total >= 12:
+                    break
+        questions[sec] = out
+
+    return {"summary": summary, "questions": questions}
+
+async def _complete(key: tuple, user: str, model: str) -> Dict[str, Any]:
+    async with _upstream_slots:
+        resp = await get_client().chat.completions.create(
+            model=model,
             temperature=0.2,
             response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "developer", "content": developer},
-                {"role": "user", "content": user},
-            ],
+            messages=[*_BASE_MESSAGES, {"role": "user", "content": user}],
         )
-        content = resp.choices[0].message.content or ""
-        parsed = json.loads(content)
-        safe = enforce_shape(parsed)
-        return safe
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+    content = resp.choices[0].message.content or ""
+    safe = enforce_shape(orjson.loads(content))
+    _response_cache[key] = safe
+    return safe
+
+def _forget_inflight(key: tuple, task: "asyncio.Task[Dict[str, Any]]") -> None:
+    _inflight.pop(key, None)
+    # Mark any error as retrieved in case every waiting caller has already gone away
+    if not task.cancelled():
+        task.exception()
+
+@app.get("/", response_class=HTMLResponse)
+async def index():
+    return HTMLResponse(content=INDEX_HTML)
+
+@app.post("/api/generate")
+async def generate(
+    dateISO: Annotated[str, Form(max_length=20)],
+    respSupport: Annotated[str, Form(max_length=30)],
+    feedingMethod: Annotated[str, Form(max_length=30)],
+    weightKg: Annotated[Optional[str], Form(max_length=20)] = None,
+    cgaWeeks: Annotated[Optional[str], Form(max_length=CGA_FORM_CAP)] = None,
+    cgaDays: Annotated[Optional[str], Form(max_length=CGA_FORM_CAP)] = None,
+    weightHistory: Annotated[Optional[str], Form(max_length=WEIGHT_HISTORY_FORM_CAP)] = None,
+    notes: Annotated[Optional[str], Form(max_length=2 * NOTES_MAX_CHARS)] = None,
+):
+    # Default form with nothing filled in: answer before doing any normalization
+    if respSupport == "Room air" and feedingMethod == "Combo" and not notes and not weightKg:
+        return Response(content=_EMPTY_PAYLOAD_BYTES, media_type="application/json")
+
+    # Fields the page cannot overfill are capped in the Form declarations above; weight history
+    # is built client-side and notes may grow on the wire (CRLF line breaks), so those are truncated
+    dateISO = dateISO.strip()
+    respSupport = respSupport.strip()
+    feedingMethod = feedingMethod.strip()
+    weightKg = weightKg.strip() if weightKg else None
+    weightHistory = clamp_text(weightHistory, WEIGHT_HISTORY_MAX_CHARS) if weightHistory else None
+    notes = clamp_text(notes, NOTES_MAX_CHARS) if notes else None
+
+    if not notes and not weightKg and respSupport == "Room air" and feedingMethod == "Combo":
+        return Response(content=_EMPTY_PAYLOAD_BYTES, media_type="application/json")
+
+    cga: Optional[str] = None
+    if cgaWeeks and _CGA_NUM_RE.fullmatch(cgaWeeks) and (not cgaDays or _CGA_NUM_RE.fullmatch(cgaDays)):
+        w = int(cgaWeeks)
+        d = int(cgaDays) if cgaDays else 0
+        if 22 <= w <= 44 and 0 <= d <= 6:
+            cga = f"{w}+{d}"
+
+    key = (dateISO, respSupport, feedingMethod, weightKg, cga, weightHistory, notes)
+    cached = _response_cache.get(key)
+    if cached is not None:
+        return ORJSONResponse(cached)
+
+    task = _inflight.get(key)
+    if task is None:
+        # Only built on a cache miss; cache hits reuse the stored payload instead
+        user = _USER_TMPL.format_map({
+            "dateISO": dateISO,
+            "cga": cga + " weeks" if cga else "unknown",
+            "respSupport": respSupport,
+            "feedingMethod": feedingMethod,
+            "weightKg": weightKg or "unknown",
+            "weightHistory": weightHistory or "none",
+            "notes": notes or "none",
+        })
+        model = DEFAULT_MODEL if len(notes or "") > LONG_NOTES_CHARS else SMALL_MODEL
+        task = asyncio.create_task(_complete(key, user, model))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _forget_inflight(key, t))
+
+    try:
+        # Shielded so one caller going away does not cancel the call for the others
+        safe = await asyncio.shield(task)
+    except RateLimitError:
+        return ORJSONResponse({"error": "The assistant is busy right now. Please try again shortly."}, status_code=429)
+    except APIError:
+        return ORJSONResponse({"error": "The assistant could not be reached. Please try again."}, status_code=502)
+    except orjson.JSONDecodeError:
+        return ORJSONResponse({"error": "The assistant returned an unreadable response. Please try again."}, status_code=500)
+    return ORJSONResponse(safe)